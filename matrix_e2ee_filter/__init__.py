@@ -1,3 +1,4 @@
+import functools
 import logging
 import synapse
 from typing import Optional, Tuple, Union
@@ -29,17 +30,33 @@ logger = logging.getLogger(__name__)
 #     matrix_e2ee_filter:
 #         level: INFO
 
+# Server default event ACL for m.room.power_levels, copied before use
+_DEFAULT_EVENT_ACL = {
+    'm.room.name': 50,
+    'm.room.power_levels': 100,
+    'm.room.history_visibility': 100,
+    'm.room.canonical_alias': 50,
+    'm.room.avatar': 50,
+    'm.room.tombstone': 100,
+    'm.room.server_acl': 100,
+    'm.room.encryption': 100
+}
+
+# Event types stripped from the initial state of newly created rooms
+_STRIP_TYPES = frozenset({'m.room.encryption', 'm.room.power_levels'})
+
+
+@functools.lru_cache(maxsize=4096)
+def _server_of(mxid):
+    # Senders and rooms recur heavily, cache the server part of the identifier
+    # Identifiers with an explicit port (more than one colon) are rejected so the event is denied
+    _, sep, server = mxid.partition(':')
+    if not sep or ':' in server:
+        raise ValueError('Unexpected server part in %r' % mxid)
+    return server
+
+
 def _patch_room_power_levels(room_power_levels, requester_user_id):
-    DEFAULT_EVENT_ACL = {
-        'm.room.name': 50,
-        'm.room.power_levels': 100,
-        'm.room.history_visibility': 100,
-        'm.room.canonical_alias': 50,
-        'm.room.avatar': 50,
-        'm.room.tombstone': 100,
-        'm.room.server_acl': 100,
-        'm.room.encryption': 100
-    }
     # Generate the new event if it's None or doesn't seem valid
     if not room_power_levels or 'content' not in room_power_levels:
         room_power_levels = {
@@ -48,7 +65,7 @@ def _patch_room_power_levels(room_power_levels, requester_user_id):
             'content': {
                 'users': { requester_user_id: 100 },
                 'users_default': 0,
-                'events': DEFAULT_EVENT_ACL,
+                'events': dict(_DEFAULT_EVENT_ACL),
                 'events_default': 0,
                 'state_default': 50,
                 'ban': 50,
@@ -70,7 +87,7 @@ def _patch_room_power_levels(room_power_levels, requester_user_id):
 
     # Patch 'events' field if present, if not - use default and still patch
     if 'events' not in content:
-        content['events'] = DEFAULT_EVENT_ACL
+        content['events'] = dict(_DEFAULT_EVENT_ACL)
 
     content['events']['m.room.encryption'] = enc_power_level
 
@@ -81,33 +98,42 @@ class EncryptedRoomFilter:
 
     def __init__(self, config: dict, api: module_api):
         self.api = api
-        self.deny_user_servers = config.get("deny_encryption_for_users_of", [])
-        self.deny_room_servers = config.get("deny_encryption_for_rooms_of", [])
+        self.deny_user_servers = frozenset(config.get("deny_encryption_for_users_of", []))
+        self.deny_room_servers = frozenset(config.get("deny_encryption_for_rooms_of", []))
+        self._deny_any = self.deny_user_servers | self.deny_room_servers
         self.patch_power_levels = config.get("patch_power_levels", False)
         self.api.register_third_party_rules_callbacks(on_create_room = self.on_create_room,)
         self.api.register_spam_checker_callbacks(check_event_for_spam=self.check_event_for_spam,)
         logger.info('Registered custom rule filter: EncryptedRoomFilter')
-        logger.info('Deny lists: users of %s; rooms of %s', self.deny_user_servers, self.deny_room_servers)
+        logger.info('Deny lists: users of %s; rooms of %s', sorted(self.deny_user_servers), sorted(self.deny_room_servers))
 
 
     async def check_event_for_spam(self, event: "synapse.events.EventBase") -> Union["synapse.module_api.NOT_SPAM", "synapse.module_api.errors.Codes"]:
         # This is probably unnecessary if m.room.power_levels are set correctly
         # Let's keep it just in case
+        deny_any = self._deny_any
+        # Avoid materializing the event dict unless there is something to check
+        if not deny_any or event.type != 'm.room.encryption':
+            return synapse.module_api.NOT_SPAM
+
         event_dict = event.get_dict()
         try:
-            event_type = event_dict.get('type', None)
-            if event_type == 'm.room.encryption':
-                _, user_server = event_dict['sender'].split(':', 2)
-                _, room_server = event_dict['room_id'].split(':', 2)
-
-                if user_server in self.deny_user_servers:
-                    logger.warn('Denied E2EE for %s / requestor', event_dict.get('room_id', '<unknown>'))
-                    return synapse.module_api.errors.Codes.FORBIDDEN
-                elif room_server in self.deny_room_servers:
-                    logger.warn('Denied E2EE for %s / room server', event_dict.get('room_id', '<unknown>'))
-                    return synapse.module_api.errors.Codes.FORBIDDEN
-        except Exception:
-            logger.warn('Exception when trying to handle the event: %s', event_dict)
+            room_id = event_dict['room_id']
+            user_server = _server_of(event_dict['sender'])
+            room_server = _server_of(room_id)
+
+            # Single combined set rejects the common, non-denied case early
+            if user_server not in deny_any and room_server not in deny_any:
+                return synapse.module_api.NOT_SPAM
+
+            if user_server in self.deny_user_servers:
+                logger.warning('Denied E2EE for %s / requestor', room_id)
+                return synapse.module_api.errors.Codes.FORBIDDEN
+            elif room_server in self.deny_room_servers:
+                logger.warning('Denied E2EE for %s / room server', room_id)
+                return synapse.module_api.errors.Codes.FORBIDDEN
+        except (KeyError, ValueError):
+            logger.warning('Exception when trying to handle the event: %s', event_dict)
             return synapse.module_api.errors.Codes.FORBIDDEN
         return synapse.module_api.NOT_SPAM
 
@@ -118,12 +144,15 @@ class EncryptedRoomFilter:
 
         filtered_initial_state = []
         initial_power_levels = None
-        for event in request_content.get('initial_state', []):
-            if event['type'] in ['m.room.encryption', 'm.room.power_levels']:
-                logger.info('Stripped "%s" from %s', event['type'], request_content.get('name', ''))
+        log_stripped = logger.isEnabledFor(logging.INFO)
+        for event in request_content.get('initial_state', ()):
+            event_type = event['type']
+            if event_type in _STRIP_TYPES:
+                if log_stripped:
+                    logger.info('Stripped "%s" from %s', event_type, request_content.get('name', ''))
 
                 # If initial power levels event is present - store it for future use
-                if event['type'] == 'm.room.power_levels':
+                if event_type == 'm.room.power_levels':
                     initial_power_levels = event
             else:
                 filtered_initial_state.append(event)